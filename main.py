@@ -1,15 +1,40 @@
 from __future__ import annotations
 
 import collections
+import functools
+import hashlib
+import json
+import mmap
+import operator
+import os
 import pathlib
 import argparse
 import re
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from importlib.metadata import PackageNotFoundError, version, requires, distributions
-from typing import List, Generator, Tuple, Set, Mapping
+from typing import List, Generator, Tuple, Set, Mapping, Dict, Deque, Optional
+
+try:
+    from packaging.requirements import Requirement, InvalidRequirement
+except ImportError:
+    Requirement = None
+
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
+
+try:
+    import platformdirs
+except ImportError:
+    platformdirs = None
 
 def helper_packages_distributions() -> Mapping[str, List[str]]:
     """
-    Copied from importlib.metadata for Python3.8 support
+    Maps top-level packages to distributions using top_level.txt only. Kept instead of
+    importlib.metadata.packages_distributions, which on Python 3.11+ also guesses packages from
+    every RECORD file: that widens the mapping and is slower to build
     """
     pkg_to_dist = collections.defaultdict(list)
     for dist in distributions():
@@ -17,23 +42,85 @@ def helper_packages_distributions() -> Mapping[str, List[str]]:
             pkg_to_dist[pkg].append(dist.metadata['Name'])
     return dict(pkg_to_dist)
 
-class DistributionDB:
-    _regex_requirement_split = re.compile(r"([^;]+)")
-    _regex_version = re.compile(r"([^\(]+)(\(([^\)]+))*")
+_cache_format_version = 1
+
+def _environment_cache_path() -> pathlib.Path:
+    """
+    The cache file name is a hash over the cache format and every installed distribution and its version
+    """
+    fingerprint = hashlib.sha256(f"{_cache_format_version}\n".encode())
+    for dist_name, dist_version in sorted((dist.metadata['Name'] or "", dist.version or "")
+                                          for dist in distributions()):
+        fingerprint.update(f"{dist_name}=={dist_version}\n".encode())
+    if platformdirs is not None:
+        cache_dir = pathlib.Path(platformdirs.user_cache_dir("py-requirements"))
+    else:
+        cache_dir = pathlib.Path.home().joinpath(".cache", "py-requirements")
+    return cache_dir.joinpath(f"{fingerprint.hexdigest()}.json")
+
+_regex_requirement = re.compile(r"\s*([A-Za-z0-9][A-Za-z0-9._-]*)\s*(?:\[([^\]]*)\])?\s*\(?([^;@)]*)")
+
+def _name_with_extras(distribution_name: str, extras) -> str:
+    if extras:
+        return f"{distribution_name}[{','.join(sorted(extras))}]"
+    return distribution_name
+
+@functools.lru_cache(maxsize=None)
+def _parse_requirement(requirement_str: str) -> Optional[Tuple[str, Optional[str]]]:
+    """
+    Uses packaging when it is installed, otherwise a regex covering name, extras and version specifiers.
+    Extras stay part of the returned name so they are kept in the generated requirements
+    """
+    if Requirement is not None:
+        try:
+            requirement = Requirement(requirement_str)
+        except InvalidRequirement:
+            return None
+        return _name_with_extras(requirement.name, requirement.extras), str(requirement.specifier) or None
+    match = _regex_requirement.match(requirement_str)
+    if not match:
+        return None
+    extras = [extra.strip() for extra in (match.group(2) or "").split(",") if extra.strip()]
+    specifiers = sorted(specifier.replace(" ", "") for specifier in match.group(3).split(",") if specifier.strip())
+    return _name_with_extras(match.group(1), extras), ",".join(specifiers) or None
+
+@functools.lru_cache(maxsize=None)
+def _cached_version(distribution_name: str) -> Optional[str]:
+    try:
+        return version(distribution_name)
+    except PackageNotFoundError:
+        return None
+
+@functools.lru_cache(maxsize=None)
+def _cached_requires(distribution_name: str) -> Optional[Tuple[str, ...]]:
+    try:
+        dist_requirements = requires(distribution_name)
+    except PackageNotFoundError:
+        return None
+    if dist_requirements is None:
+        return None
+    return tuple(dist_requirements)
 
+class DistributionDB:
+    @functools.total_ordering
     class DistributionEntry:
+        __slots__ = ('__name', '__name_lower', '__currently_processed', '__version_provided', '__version_detected',
+                     '__requirements', '__version', '__str_cache')
+
         def __init__(self, provided_dist_name: str, version_str: str = None) -> None:
             self.__name = provided_dist_name
+            self.__name_lower = provided_dist_name.lower()
             self.__currently_processed = True
             self.__version_provided = True if version_str is not None else False
             self.__version_detected = False
             self.__requirements: Set[DistributionDB.DistributionEntry] = set()
+            self.__str_cache: Optional[str] = None
 
             if version_str is None:
-                try:
-                    self.__version = version(self.__name)
+                self.__version = _cached_version(self.__name)
+                if self.__version is not None:
                     self.__version_detected = True
-                except PackageNotFoundError:
+                else:
                     try:
                         self.__version = getattr(__import__(self.__name), "__version__")
                         self.__version_detected = True
@@ -43,20 +130,39 @@ class DistributionDB:
                 self.__version = version_str
 
         def inspect_requirements(self) -> Generator[Tuple[str, str], None, None]:
-            installed = True
-            dist_requirements = None
-            try:
-                dist_requirements = requires(self.__name)
-            except PackageNotFoundError:
-                installed = False
-            if installed:
-                if dist_requirements is not None:
-                    for dist_requirement in dist_requirements:
-                        concrete_requirement = DistributionDB._regex_requirement_split.match(dist_requirement)
-                        if concrete_requirement:
-                            concrete_requirement_str = concrete_requirement[0].strip()
-                            result = DistributionDB._regex_version.search(concrete_requirement_str)
-                            yield result.group(1), result.group(3)
+            if self.__version_provided:
+                return
+            dist_requirements = _cached_requires(self.__name)
+            if dist_requirements is not None:
+                for dist_requirement in dist_requirements:
+                    requirement_tuple = _parse_requirement(dist_requirement)
+                    if requirement_tuple is not None:
+                        yield requirement_tuple
+
+        def to_json(self) -> dict:
+            return {
+                "name": self.__name,
+                "version": self.__version,
+                "version_provided": self.__version_provided,
+                "version_detected": self.__version_detected,
+                "requirements": [[r.name_lower, r.version] for r in self.__requirements]
+            }
+
+        @classmethod
+        def from_json(cls, entry_json: dict) -> DistributionDB.DistributionEntry:
+            """
+            Restores an entry without querying the environment; requirements are linked by DistributionDB
+            """
+            entry = cls.__new__(cls)
+            entry.__name = entry_json["name"]
+            entry.__name_lower = entry.__name.lower()
+            entry.__currently_processed = False
+            entry.__version_provided = entry_json["version_provided"]
+            entry.__version_detected = entry_json["version_detected"]
+            entry.__requirements = set()
+            entry.__version = entry_json["version"]
+            entry.__str_cache = None
+            return entry
 
         def requirements(self) -> Generator[DistributionDB.DistributionEntry, None, None]:
             for current_requirement in self.__requirements:
@@ -76,65 +182,53 @@ class DistributionDB:
         def name(self) -> str:
             return self.__name
 
+        @property
+        def name_lower(self) -> str:
+            return self.__name_lower
+
         @property
         def version(self) -> str:
             return self.__version
 
-        def __eq__(self, other):
-            if isinstance(other, self.__class__):
-                return self.name.lower() == other.name.lower() and self.version == other.version
+        @property
+        def version_provided(self) -> bool:
+            return self.__version_provided
 
-        def __gt__(self, other):
+        def __eq__(self, other):
             if isinstance(other, self.__class__):
-                if self.name.lower() > other.name.lower():
-                    return True
-                if self.name.lower() == other.name.lower():
-                    return self.version > other.version
-                return False
-
-        def __ne__(self, other):
-            return not self == other
-
-        def __ge__(self, other):
-            return self == other or self > other
+                return self.__name_lower == other.__name_lower and self.__version == other.__version
+            return NotImplemented
 
         def __lt__(self, other):
-            return not self >= other
-
-        def __le__(self, other):
-            return not self < other
+            if isinstance(other, self.__class__):
+                return (self.__name_lower, self.__version) < (other.__name_lower, other.__version)
+            return NotImplemented
 
         def __hash__(self):
-            return hash((self.name, self.version))
+            return hash((self.__name_lower, self.__version))
 
         def __str__(self):
-            if self.__version_provided:
-                return f"{self.name}{self.version}"
-            else:
-                if self.__version_detected:
-                    return f"{self.name} ={self.version}"
+            if self.__str_cache is None:
+                if self.__version_provided:
+                    self.__str_cache = f"{self.name}{self.version}"
                 else:
-                    return f"{self.name}"
-
-    def __done(self) -> bool:
-        for current_distribution_entry in self.__known_distributions:
-            if not current_distribution_entry.finalized:
-                return False
-        return True
+                    if self.__version_detected:
+                        self.__str_cache = f"{self.name} ={self.version}"
+                    else:
+                        self.__str_cache = f"{self.name}"
+            return self.__str_cache
+
+    def __register(self, entry: DistributionDB.DistributionEntry) -> None:
+        self.__known_distributions.add(entry)
+        self.__by_key[(entry.name_lower, entry.version)] = entry
+        if not entry.version_provided:
+            self.__by_name[entry.name].append(entry)
 
     def find(self, provided_distribution_name: str, provided_version: str):
-        h = hash((provided_distribution_name, provided_version))
-        for d in self.__known_distributions:
-            if hash(d) == h:
-                return d
-        return None
+        return self.__by_key.get((provided_distribution_name.lower(), provided_version))
 
     def find_by_name(self, provided_distribution_name: str) -> List[DistributionDB.DistributionEntry]:
-        result = []
-        for d in self.__known_distributions:
-            if d.name == provided_distribution_name:
-                result.append(d)
-        return result
+        return list(self.__by_name.get(provided_distribution_name, []))
 
     def package_known(self, package_name: str):
         return package_name in self.__installed_packages
@@ -143,49 +237,170 @@ class DistributionDB:
         if package_name in self.__installed_packages:
             return self.__installed_packages[package_name]
 
-    def __init__(self):
+    def __load_cache(self, cache_path: pathlib.Path) -> bool:
+        try:
+            with open(cache_path, "r") as cache_file:
+                cache_json = json.load(cache_file)
+            self.__installed_packages = cache_json["installed_packages"]
+            entries_json = cache_json["distributions"]
+            for entry_json in entries_json:
+                self.__register(DistributionDB.DistributionEntry.from_json(entry_json))
+            for entry_json in entries_json:
+                entry = self.find(entry_json["name"], entry_json["version"])
+                for requirement_name, requirement_version in entry_json["requirements"]:
+                    requirement_entry = self.find(requirement_name, requirement_version)
+                    if requirement_entry is None:
+                        raise KeyError(requirement_name)
+                    entry.add_requirement(requirement_entry)
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            self.__known_distributions.clear()
+            self.__by_key.clear()
+            self.__by_name.clear()
+            return False
+        return True
+
+    def __store_cache(self, cache_path: pathlib.Path) -> None:
+        cache_json = {
+            "installed_packages": self.__installed_packages,
+            "distributions": [entry.to_json() for entry in self.__known_distributions]
+        }
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            cache_file = tempfile.NamedTemporaryFile("w", dir=cache_path.parent, suffix=".tmp", delete=False)
+        except OSError:
+            return
+        # Concurrent runs only ever see a complete cache file
+        try:
+            with cache_file:
+                json.dump(cache_json, cache_file, default=str)
+            os.replace(cache_file.name, cache_path)
+        except OSError:
+            pathlib.Path(cache_file.name).unlink(missing_ok=True)
+
+    def __init__(self, use_cache: bool = True):
         self.__known_distributions: Set[DistributionDB.DistributionEntry] = set()
+        self.__by_key: Dict[Tuple[str, str], DistributionDB.DistributionEntry] = {}
+        self.__by_name: Dict[str, List[DistributionDB.DistributionEntry]] = collections.defaultdict(list)
+
+        cache_path = _environment_cache_path() if use_cache else None
+        if cache_path is not None and self.__load_cache(cache_path):
+            return
+
         self.__installed_packages: Mapping[str, List[str]] = helper_packages_distributions()
         for distribution_names in self.__installed_packages.values():
             for current_distribution_name in distribution_names:
                 distribution_obj = DistributionDB.DistributionEntry(current_distribution_name)
-                if distribution_obj not in self.__known_distributions:
-                    self.__known_distributions.add(distribution_obj)
-
-        while not self.__done():
-            requirements_to_add: Set[DistributionDB.DistributionEntry] = set()
-            for current_distribution_entry in self.__known_distributions:
-                if not current_distribution_entry.finalized:
-                    for requirement_tuple in current_distribution_entry.inspect_requirements():
-                        requirement_object = self.find(requirement_tuple[0], requirement_tuple[1])
-                        if requirement_object is None:
-                            requirement_object = DistributionDB.DistributionEntry(requirement_tuple[0],
-                                                                                  requirement_tuple[1])
-                        current_distribution_entry.add_requirement(requirement_object)
-                        requirements_to_add.add(requirement_object)
-                    current_distribution_entry.finalize()
-            self.__known_distributions.update(requirements_to_add)
+                if self.find(distribution_obj.name, distribution_obj.version) is None:
+                    self.__register(distribution_obj)
+
+        pending: Deque[DistributionDB.DistributionEntry] = collections.deque(self.__known_distributions)
+        while pending:
+            current_distribution_entry = pending.popleft()
+            for requirement_tuple in current_distribution_entry.inspect_requirements():
+                requirement_object = self.find(requirement_tuple[0], requirement_tuple[1])
+                if requirement_object is None:
+                    requirement_object = DistributionDB.DistributionEntry(requirement_tuple[0],
+                                                                          requirement_tuple[1])
+                    known_object = self.find(requirement_object.name, requirement_object.version)
+                    if known_object is None:
+                        self.__register(requirement_object)
+                        pending.append(requirement_object)
+                    else:
+                        requirement_object = known_object
+                current_distribution_entry.add_requirement(requirement_object)
+            current_distribution_entry.finalize()
+
+        if cache_path is not None:
+            self.__store_cache(cache_path)
 
     def print(self):
         for dist in self.__known_distributions:
             print(f"{dist}")
 
 
+def _walk_python_files(root_path) -> Generator[str, None, None]:
+    try:
+        entries = os.scandir(root_path)
+    except PermissionError:
+        return
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if 'venv' not in entry.name:
+                    yield from _walk_python_files(entry.path)
+            elif entry.name.endswith(".py"):
+                yield entry.path
+
+
+_regex_import = re.compile(rb"^[ \t]*(?:import[ \t]+([\w.]+)|from[ \t]+([\w.]+)[ \t]+import)", re.MULTILINE)
+_parallel_scan_threshold = 50
+_non_word_bytes = bytes(c for c in range(256) if not (chr(c).isascii() and (chr(c).isalnum() or chr(c) == "_")))
+_non_word_to_space = bytes.maketrans(_non_word_bytes, b" " * len(_non_word_bytes))
+
+
+def _compile_import_database():
+    """
+    Hyperscan has no capture groups: pattern 0 ends on the first character of the imported module and
+    pattern 1 spans the whole 'from x import' prefix, so names are sliced from the reported offsets
+    """
+    if hyperscan is None:
+        return None
+    database = hyperscan.Database()
+    database.compile(expressions=[rb"^[ \t]*import[ \t]+\w", rb"^[ \t]*from[ \t]+\w[\w.]*[ \t]+import"],
+                     ids=[0, 1],
+                     flags=[hyperscan.HS_FLAG_MULTILINE | hyperscan.HS_FLAG_SOM_LEFTMOST] * 2)
+    return database
+
+
+_hyperscan_import_db = _compile_import_database()
+
+
+def _scan_buffer_hyperscan(buffer) -> Set[str]:
+    buffer_imports = set()
+
+    def on_match(expression_id, from_offset, to_offset, flags, context):
+        if expression_id == 0:
+            statement = buffer[to_offset - 1:to_offset + 255].translate(_non_word_to_space)
+            buffer_imports.add(statement.split(None, 1)[0].decode())
+        else:
+            statement = buffer[from_offset:to_offset].translate(_non_word_to_space)
+            buffer_imports.add(statement.split()[1].decode())
+
+    _hyperscan_import_db.scan(buffer, match_event_handler=on_match)
+    return buffer_imports
+
+
+def _scan_buffer_re(buffer) -> Set[str]:
+    buffer_imports = set()
+    for match in _regex_import.finditer(buffer):
+        import_match = match.group(1) or match.group(2)
+        package_name = import_match.split(b".", 1)[0]
+        if package_name:
+            buffer_imports.add(package_name.decode())
+    return buffer_imports
+
+
+def _scan_one_file(path: str) -> Set[str]:
+    with open(path, 'rb') as py:
+        if os.fstat(py.fileno()).st_size == 0:
+            return set()
+        with mmap.mmap(py.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            if _hyperscan_import_db is not None:
+                return _scan_buffer_hyperscan(buffer)
+            return _scan_buffer_re(buffer)
+
+
 def get_imports_from_root(root_path: pathlib.Path) -> List[str]:
-    files = [f for f in root_path.rglob("*.py") if 'venv' not in f"{f}"]
-    regex_import = re.compile(r"(import (\S+)\s*)|(from\s+(\S+)\s+import\s+\S+)")
-    regex_split = re.compile(r"([^.,\s]+)")
+    files = list(_walk_python_files(root_path))
 
     current_imports = set()
-    for f in files:
-        with open(f, 'r') as py:
-            lines = py.read()
-            matches = regex_import.finditer(lines, re.MULTILINE)
-            for matchNum, match in enumerate(matches, start=1):
-                import_match = match.group(2) if match.group(2) is not None else match.group(4)
-                to_add_match = regex_split.match(import_match)
-                if to_add_match:
-                    current_imports.add(to_add_match[0])
+    if len(files) < _parallel_scan_threshold or (os.cpu_count() or 1) <= 1:
+        for f in files:
+            current_imports.update(_scan_one_file(f))
+    else:
+        with ProcessPoolExecutor() as executor:
+            for file_imports in executor.map(_scan_one_file, files, chunksize=32):
+                current_imports.update(file_imports)
     imports_list = list(current_imports)
     imports_list.sort()
     return imports_list
@@ -196,6 +411,8 @@ if __name__ == '__main__':
     parser.add_argument('-r', '--tvlRootPath', type=pathlib.Path, dest="rootPath")
     parser.add_argument('-o', '--out', type=pathlib.Path, dest="outPath",
                         default=pathlib.Path("./out/requirements.txt"))
+    parser.add_argument('--no-cache', action='store_false', dest="useCache",
+                        help="Resolve the installed distributions without reading or writing the on-disk cache")
     args = parser.parse_args()
 
     args_dict = {key: value for key, value in vars(args).items()}
@@ -210,42 +427,43 @@ if __name__ == '__main__':
     rootPath = pathlib.Path(args_dict["rootPath"])
 
     imports = get_imports_from_root(rootPath)
-    distro_db = DistributionDB()
+    distro_db = DistributionDB(args_dict["useCache"])
+
+    imports_to_entries: Dict[str, List[DistributionDB.DistributionEntry]] = {
+        import_package_name: [distribution_entry
+                              for distribution_name in distro_db.find_from_package(import_package_name)
+                              for distribution_entry in distro_db.find_by_name(distribution_name)]
+        for import_package_name in imports if distro_db.package_known(import_package_name)
+    }
 
-    distribution_list: List[str] = []
-    output_list: List[DistributionDB.DistributionEntry] = []
+    distribution_set: Set[str] = set()
+    dependencies_list: List[DistributionDB.DistributionEntry] = []
+    required_list: List[DistributionDB.DistributionEntry] = []
 
-    with open(out, "w") as file:
+    with open(out, "w", buffering=1 << 20) as file:
         file.write("# ========= BEGIN Dependencies of required packages ========= #\n")
-        for import_package_name in imports:
-            if distro_db.package_known(import_package_name):
-                for distribution_name in distro_db.find_from_package(import_package_name):
-                    for distribution_entry in distro_db.find_by_name(distribution_name):
-                        file.write(f"# Requirement for {distribution_entry}\n")
-                        for requirement in distribution_entry.requirements():
-                            if str(requirement) not in distribution_list:
-                                file.write(f"# \t{str(requirement)}\n")
-                                distribution_list.append(str(requirement))
-                                output_list.append(requirement)
-        output_list.sort()
-        for r in output_list:
-            file.write(f"{r}\n")
-        output_list.clear()
+        for distribution_entries in imports_to_entries.values():
+            for distribution_entry in distribution_entries:
+                file.write(f"# Requirement for {distribution_entry}\n")
+                for requirement in distribution_entry.requirements():
+                    if str(requirement) not in distribution_set:
+                        file.write(f"# \t{str(requirement)}\n")
+                        distribution_set.add(str(requirement))
+                        dependencies_list.append(requirement)
+        dependencies_list.sort(key=operator.attrgetter('name_lower', 'version'))
+        file.writelines(f"{r}\n" for r in dependencies_list)
         file.write("# =========  END  Dependencies of required packages ========= #\n")
 
         file.write("# ========= BEGIN         Required packages         ========= #\n")
-        for import_package_name in imports:
-            if distro_db.package_known(import_package_name):
-                for distribution_name in distro_db.find_from_package(import_package_name):
-                    for distribution_entry in distro_db.find_by_name(distribution_name):
-                        if str(distribution_entry) not in distribution_list:
-                            distribution_list.append(str(distribution_entry))
-                            output_list.append(distribution_entry)
-        output_list.sort()
-        for r in output_list:
-            file.write(f"{r}\n")
+        for distribution_entries in imports_to_entries.values():
+            for distribution_entry in distribution_entries:
+                if str(distribution_entry) not in distribution_set:
+                    distribution_set.add(str(distribution_entry))
+                    required_list.append(distribution_entry)
+        required_list.sort(key=operator.attrgetter('name_lower', 'version'))
+        file.writelines(f"{r}\n" for r in required_list)
         file.write("# =========  END          Required packages         ========= #\n")
         for import_package_name in imports:
-            if not distro_db.package_known(import_package_name):
+            if import_package_name not in imports_to_entries:
                 file.write(f"# Doesn't know package {import_package_name}.\n")
 
@@ -0,0 +1,169 @@
+import json
+import os
+import pathlib
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+MAIN_PATH = pathlib.Path(__file__).resolve().parent.parent.joinpath("main.py")
+sys.path.insert(0, str(MAIN_PATH.parent))
+
+import main
+
+
+def write_distribution(site_path: pathlib.Path, name: str, version: str, requirements=()) -> None:
+    dist_info = site_path.joinpath(f"{name.replace('-', '_')}-{version}.dist-info")
+    dist_info.mkdir()
+    metadata = ["Metadata-Version: 2.1", f"Name: {name}", f"Version: {version}"]
+    metadata += [f"Requires-Dist: {requirement}" for requirement in requirements]
+    dist_info.joinpath("METADATA").write_text("\n".join(metadata) + "\n")
+    dist_info.joinpath("top_level.txt").write_text(name.replace('-', '_') + "\n")
+    dist_info.joinpath("RECORD").write_text("")
+
+
+def section(lines, title: str):
+    begin = next(i for i, line in enumerate(lines) if line.startswith("# ========= BEGIN") and title in line)
+    end = next(i for i, line in enumerate(lines) if i > begin and line.startswith("# =========  END"))
+    return [line for line in lines[begin + 1:end] if not line.startswith("#")]
+
+
+class RequirementsFileTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp_path = pathlib.Path(tmp.name)
+        self.site_path = self.tmp_path.joinpath("site")
+        self.site_path.mkdir()
+        write_distribution(self.site_path, "pyreqtest-alpha", "1.0", ["pyreqtest-gamma[extra]>=0.5"])
+        write_distribution(self.site_path, "pyreqtest-beta", "2.1")
+        write_distribution(self.site_path, "pyreqtest-gamma", "0.7", ["pyreqtest-beta<3,>=2.0"])
+        self.source_path = self.tmp_path.joinpath("src")
+        self.source_path.mkdir()
+        self.source_path.joinpath("app.py").write_text("import pyreqtest_alpha\nimport pyreqtest_beta\n")
+        self.home_path = self.tmp_path.joinpath("home")
+        self.home_path.mkdir()
+
+    def run_main(self, out_name: str, *args):
+        out_path = self.tmp_path.joinpath("out", out_name)
+        python_path = [str(self.site_path)] + [p for p in os.environ.get("PYTHONPATH", "").split(os.pathsep) if p]
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(python_path), HOME=str(self.home_path),
+                   XDG_CACHE_HOME=str(self.home_path.joinpath(".cache")))
+        subprocess.run([sys.executable, str(MAIN_PATH), "-r", str(self.source_path), "-o", str(out_path), *args],
+                       check=True, env=env)
+        return out_path.read_text().splitlines()
+
+    def cache_files(self):
+        return sorted(self.home_path.rglob("*.json")), sorted(self.home_path.rglob("*.tmp"))
+
+    def test_one_line_per_required_distribution(self):
+        lines = self.run_main("requirements.txt", "--no-cache")
+
+        self.assertEqual(section(lines, "Dependencies of required packages"), ["pyreqtest-gamma[extra]>=0.5"])
+        self.assertEqual(section(lines, "Required packages"), ["pyreqtest-alpha =1.0", "pyreqtest-beta =2.1"])
+        self.assertNotIn("# Requirement for pyreqtest-beta<3,>=2.0", lines)
+        self.assertEqual(self.cache_files(), ([], []))
+
+    def test_cache_round_trip(self):
+        uncached = self.run_main("uncached.txt", "--no-cache")
+        first = self.run_main("first.txt")
+        json_files, tmp_files = self.cache_files()
+        self.assertEqual(len(json_files), 1)
+        self.assertEqual(tmp_files, [])
+        second = self.run_main("second.txt")
+
+        self.assertEqual(first, second)
+        self.assertEqual(first, uncached)
+
+    def test_invalid_cache_is_rebuilt(self):
+        expected = self.run_main("first.txt")
+        json_files, _ = self.cache_files()
+        json_files[0].write_text(json.dumps({"installed_packages": {}, "distributions": [
+            {"name": None, "version": "1.0", "version_provided": False, "version_detected": True,
+             "requirements": []}]}))
+        rebuilt = self.run_main("rebuilt.txt")
+
+        self.assertEqual(rebuilt, expected)
+        self.assertIn("pyreqtest-alpha", json_files[0].read_text())
+
+
+class ParseRequirementTest(unittest.TestCase):
+    cases = {
+        "x[extra]>=1": ("x[extra]", ">=1"),
+        "build[virtualenv]": ("build[virtualenv]", None),
+        "coverage[toml] >=5.0.2": ("coverage[toml]", ">=5.0.2"),
+        "multi[b, a] (<3,>=2.0) ; extra == 'test'": ("multi[a,b]", "<3,>=2.0"),
+        "plain": ("plain", None),
+    }
+
+    def test_fallback_parser(self):
+        with mock.patch.object(main, "Requirement", None):
+            for requirement_str, expected in self.cases.items():
+                self.assertEqual(main._parse_requirement.__wrapped__(requirement_str), expected)
+
+    @unittest.skipIf(main.Requirement is None, "packaging is not installed")
+    def test_packaging_parser(self):
+        for requirement_str, expected in self.cases.items():
+            self.assertEqual(main._parse_requirement.__wrapped__(requirement_str), expected)
+
+
+class ImportScanTest(unittest.TestCase):
+    def test_skips_venv_directories_only(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root_path = pathlib.Path(tmp)
+            root_path.joinpath("venv_utils.py").write_text("import json\n")
+            root_path.joinpath("pkg").mkdir()
+            root_path.joinpath("pkg", "module.py").write_text("from os.path import join\nimport sys, re\n")
+            root_path.joinpath(".venv").mkdir()
+            root_path.joinpath(".venv", "site.py").write_text("import hidden\n")
+
+            self.assertEqual(main.get_imports_from_root(root_path), ["json", "os", "sys"])
+
+    def write_many_files(self, root_path: pathlib.Path):
+        for index in range(main._parallel_scan_threshold + 10):
+            root_path.joinpath(f"module_{index}.py").write_text(f"import pkg_{index % 7}.sub\nfrom os import path\n")
+        return sorted({f"pkg_{index}" for index in range(7)} | {"os"})
+
+    def test_parallel_scan(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root_path = pathlib.Path(tmp)
+            expected = self.write_many_files(root_path)
+            with mock.patch.object(main.os, "cpu_count", return_value=2), \
+                    mock.patch.object(main, "ProcessPoolExecutor", wraps=main.ProcessPoolExecutor) as executor:
+                self.assertEqual(main.get_imports_from_root(root_path), expected)
+            executor.assert_called_once()
+
+    def test_single_cpu_scans_sequentially(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root_path = pathlib.Path(tmp)
+            expected = self.write_many_files(root_path)
+            with mock.patch.object(main.os, "cpu_count", return_value=1), \
+                    mock.patch.object(main, "ProcessPoolExecutor") as executor:
+                self.assertEqual(main.get_imports_from_root(root_path), expected)
+            executor.assert_not_called()
+
+    @unittest.skipIf(hasattr(os, "geteuid") and os.geteuid() == 0, "root can read any directory")
+    def test_skips_unreadable_directories(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root_path = pathlib.Path(tmp)
+            root_path.joinpath("app.py").write_text("import json\n")
+            locked_path = root_path.joinpath("locked")
+            locked_path.mkdir()
+            locked_path.joinpath("hidden.py").write_text("import hidden\n")
+            locked_path.chmod(0)
+            try:
+                self.assertEqual(main.get_imports_from_root(root_path), ["json"])
+            finally:
+                locked_path.chmod(0o700)
+
+    @unittest.skipIf(main.hyperscan is None, "hyperscan is not installed")
+    def test_hyperscan_matches_re(self):
+        source = (b"import os\nfrom a.b import c\n    import x.y as z\nfrom . import rel\n"
+                  b"text = '''\nimport\nkeyword\n'''\nimport sys, re\nfrom\tq  import r\nimport last")
+        self.assertEqual(main._scan_buffer_hyperscan(source), main._scan_buffer_re(source))
+        self.assertEqual(main._scan_buffer_re(source), {"os", "a", "x", "sys", "q", "last"})
+
+
+if __name__ == '__main__':
+    unittest.main()